@@ -10,7 +10,15 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
+import importlib
+import json
+import os
+import sys
+
 from oslo_log import log as logging
+from stevedore import driver
+from stevedore import exception as stevedore_exception
 from stevedore import extension
 
 import os_vif.exception
@@ -20,29 +28,157 @@ import os_vif.objects
 _LE = os_vif.i18n._LE
 _LI = os_vif.i18n._LI
 
-_EXT_MANAGER = None
+_INITIALIZED = False
+_OBJECTS_REGISTERED = False
+_DRIVER_CACHE = {}
+# Map of plugin name to 'module:class', either read back from the
+# on-disk plugin cache or built by the first full namespace scan.  The
+# cache is only read, and its key computed, when a plugin is first
+# needed.
+_PLUGIN_CLASSES = None
+_PLUGIN_CACHE_KEY = None
 LOG = logging.getLogger('os_vif')
 
 
+def _plugin_cache_path():
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'os_vif', 'plugins.json')
+
+
+def _plugin_cache_key():
+    """
+    Return a key that changes whenever a Python distribution is
+    installed, upgraded or removed, based on the modification times and
+    sizes of the distribution metadata found on sys.path.
+    """
+    stamps = []
+    for entry in sys.path:
+        entry = entry or '.'
+        try:
+            if not os.path.isdir(entry):
+                stamps.append('%s:%s' % (entry, os.stat(entry).st_mtime))
+                continue
+            names = os.listdir(entry)
+        except OSError:
+            continue
+        for name in names:
+            if name.endswith(('.dist-info', '.egg-info', '.egg-link')):
+                path = os.path.join(entry, name)
+                if os.path.isdir(path):
+                    # 'setup.py develop' rewrites entry_points.txt in
+                    # place, which leaves the directory mtime alone.
+                    path = os.path.join(path, 'entry_points.txt')
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                stamps.append('%s:%s:%s' % (path, st.st_mtime, st.st_size))
+    return hashlib.sha256(
+        '\n'.join(sorted(stamps)).encode('utf-8')).hexdigest()
+
+
+def _read_plugin_cache(key):
+    try:
+        with open(_plugin_cache_path()) as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if not isinstance(cache, dict) or cache.get('key') != key:
+        return None
+    return cache.get('plugins')
+
+
+def _write_plugin_cache(key, plugins):
+    path = _plugin_cache_path()
+    tmp_path = '%s.%d' % (path, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': key, 'plugins': plugins}, f)
+        os.rename(tmp_path, path)
+    except (IOError, OSError) as err:
+        LOG.debug("Unable to write os_vif plugin cache %(path)s: %(err)s",
+                  {'path': path, 'err': err})
+
+
+def _load_plugin_cache():
+    global _PLUGIN_CLASSES
+    global _PLUGIN_CACHE_KEY
+    if _PLUGIN_CACHE_KEY is None:
+        _PLUGIN_CACHE_KEY = _plugin_cache_key()
+        _PLUGIN_CLASSES = _read_plugin_cache(_PLUGIN_CACHE_KEY)
+
+
 def initialize(reset=False):
     """
-    Loads all os_vif plugins and initializes them with a dictionary of
-    configuration options. These configuration options are passed as-is
-    to the individual VIF plugins that are loaded via stevedore.
+    Initializes the os_vif library. The plugins themselves are not
+    loaded until they are first needed by plug(), unplug() or
+    host_info(), at which point their configuration options are
+    registered and passed as-is to the plugin.
+
+    If the plugins found by a previous process are still valid, their
+    classes are imported directly on first use instead of scanning the
+    os_vif entry point namespace.
+
+    :param reset: Discard any VIF plugins that were already loaded.
+
+    """
+    global _INITIALIZED
+    global _OBJECTS_REGISTERED
+    global _PLUGIN_CLASSES
+    global _PLUGIN_CACHE_KEY
+    if reset or not _INITIALIZED:
+        _DRIVER_CACHE.clear()
+        _PLUGIN_CACHE_KEY = None
+        _PLUGIN_CLASSES = None
+
+        # The object registry is process wide and unaffected by reset
+        if not _OBJECTS_REGISTERED:
+            os_vif.objects.register_all()
+            _OBJECTS_REGISTERED = True
+        _INITIALIZED = True
 
-    :param reset: Recreate and load the VIF plugin extensions.
 
+def _get_plugin(plugin_name):
     """
-    global _EXT_MANAGER
-    if reset or (_EXT_MANAGER is None):
-        _EXT_MANAGER = extension.ExtensionManager(namespace='os_vif',
-                                                  invoke_on_load=False)
-        for plugin_name in _EXT_MANAGER.names():
-            cls = _EXT_MANAGER[plugin_name].plugin
-            obj = cls.load(plugin_name)
-            _EXT_MANAGER[plugin_name].obj = obj
+    Return the loaded plugin object for the given name, loading only
+    that plugin's entry point on first use.
 
-        os_vif.objects.register_all()
+    :param plugin_name: the name of the plugin extension
+    :raises `exception.NoMatchingPlugin` if there is no plugin with
+            that name.
+    """
+    plugin = _DRIVER_CACHE.get(plugin_name)
+    if plugin is None:
+        cls = _get_plugin_class(plugin_name)
+        plugin = _DRIVER_CACHE.setdefault(plugin_name,
+                                          cls.load(plugin_name))
+    return plugin
+
+
+def _get_plugin_class(plugin_name):
+    global _PLUGIN_CLASSES
+    _load_plugin_cache()
+    target = (_PLUGIN_CLASSES or {}).get(plugin_name)
+    if target:
+        module_name, _sep, class_name = target.partition(':')
+        try:
+            return getattr(importlib.import_module(module_name), class_name)
+        except (ImportError, AttributeError) as err:
+            # Stop trusting the cache; host_info() will rescan.
+            LOG.debug("Cached os_vif plugin %(name)s is stale: %(err)s",
+                      {'name': plugin_name, 'err': err})
+            _PLUGIN_CLASSES = None
+
+    try:
+        mgr = driver.DriverManager(namespace='os_vif',
+                                   name=plugin_name,
+                                   invoke_on_load=False)
+    except stevedore_exception.NoMatches:
+        raise os_vif.exception.NoMatchingPlugin(plugin_name=plugin_name)
+    return mgr.driver
 
 
 def plug(vif, instance_info):
@@ -59,14 +195,10 @@ def plug(vif, instance_info):
     :raises `exception.PlugException` if anything fails during unplug
             operations.
     """
-    if _EXT_MANAGER is None:
+    if not _INITIALIZED:
         raise os_vif.exception.LibraryNotInitialized()
 
-    plugin_name = vif.plugin
-    try:
-        plugin = _EXT_MANAGER[plugin_name].obj
-    except KeyError:
-        raise os_vif.exception.NoMatchingPlugin(plugin_name=plugin_name)
+    plugin = _get_plugin(vif.plugin)
 
     try:
         LOG.debug("Plugging vif %s", vif)
@@ -92,14 +224,10 @@ def unplug(vif, instance_info):
     :raises `exception.UnplugException` if anything fails during unplug
             operations.
     """
-    if _EXT_MANAGER is None:
+    if not _INITIALIZED:
         raise os_vif.exception.LibraryNotInitialized()
 
-    plugin_name = vif.plugin
-    try:
-        plugin = _EXT_MANAGER[plugin_name].obj
-    except KeyError:
-        raise os_vif.exception.NoMatchingPlugin(plugin_name=plugin_name)
+    plugin = _get_plugin(vif.plugin)
 
     try:
         LOG.debug("Unplugging vif %s", vif)
@@ -111,6 +239,24 @@ def unplug(vif, instance_info):
         raise os_vif.exception.UnplugException(vif=vif, err=err)
 
 
+def _scan_plugins():
+    """
+    Load every plugin in the os_vif namespace and record their classes
+    in the on-disk plugin cache.
+    """
+    global _PLUGIN_CLASSES
+    mgr = extension.ExtensionManager(namespace='os_vif',
+                                     invoke_on_load=False)
+    plugin_classes = {}
+    for ext in mgr:
+        if ext.name not in _DRIVER_CACHE:
+            _DRIVER_CACHE[ext.name] = ext.plugin.load(ext.name)
+        plugin_classes[ext.name] = '%s:%s' % (ext.plugin.__module__,
+                                              ext.plugin.__name__)
+    _PLUGIN_CLASSES = plugin_classes
+    _write_plugin_cache(_PLUGIN_CACHE_KEY, _PLUGIN_CLASSES)
+
+
 def host_info():
     """
     Get information about the host platform configuration to be
@@ -119,13 +265,25 @@ def host_info():
 
     :returns: a os_vif.host_info.HostInfo class instance
     """
-
-    if _EXT_MANAGER is None:
+    if not _INITIALIZED:
         raise os_vif.exception.LibraryNotInitialized()
 
-    plugins = [
-        _EXT_MANAGER[name].obj.describe()
-        for name in _EXT_MANAGER.names()
-    ]
+    # Describing the host needs every plugin, so unless a previous
+    # process left us a valid plugin cache this is the only place where
+    # the whole namespace is enumerated.
+    _load_plugin_cache()
+    if _PLUGIN_CLASSES is not None:
+        # A cached class that no longer imports discards the cache,
+        # whether or not the plugin is still in the namespace.
+        try:
+            for name in sorted(_PLUGIN_CLASSES):
+                _get_plugin(name)
+        except os_vif.exception.NoMatchingPlugin:
+            pass
+    if _PLUGIN_CLASSES is None:
+        _scan_plugins()
+
+    plugins = [_get_plugin(name).describe()
+               for name in sorted(_PLUGIN_CLASSES)]
 
     return os_vif.objects.host_info.HostInfo(plugin_info=plugins)
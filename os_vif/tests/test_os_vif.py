@@ -10,8 +10,11 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import fixtures
 import mock
+import os
 from oslo_config import cfg
+from stevedore import exception as stevedore_exception
 from stevedore import extension
 
 import os_vif
@@ -58,18 +61,37 @@ class TestOSVIF(base.TestCase):
 
     def setUp(self):
         super(TestOSVIF, self).setUp()
-        os_vif._EXT_MANAGER = None
+        os_vif._INITIALIZED = False
+        os_vif._PLUGIN_CLASSES = None
+        os_vif._PLUGIN_CACHE_KEY = None
+        os_vif._DRIVER_CACHE.clear()
+        self.cache_home = self.useFixture(fixtures.TempDir()).path
+        self.useFixture(fixtures.EnvironmentVariable('XDG_CACHE_HOME',
+                                                     self.cache_home))
 
+    @mock.patch.object(os_vif, '_plugin_cache_key')
+    @mock.patch('stevedore.driver.DriverManager')
     @mock.patch('stevedore.extension.ExtensionManager')
-    def test_initialize(self, mock_EM):
-        self.assertIsNone(os_vif._EXT_MANAGER)
+    def test_initialize(self, mock_EM, mock_DM, mock_key):
+        self.assertFalse(os_vif._INITIALIZED)
         # Note: the duplicate call for initialize is to validate
-        # that the extension manager is only initialized once
+        # that the library is only initialized once, and that no
+        # plugin is looked up until it is needed
         os_vif.initialize()
         os_vif.initialize()
-        mock_EM.assert_called_once_with(
-            invoke_on_load=False, namespace='os_vif')
-        self.assertIsNotNone(os_vif._EXT_MANAGER)
+        os_vif.initialize(reset=True)
+        self.assertTrue(os_vif._INITIALIZED)
+        self.assertFalse(mock_EM.called)
+        self.assertFalse(mock_DM.called)
+        self.assertFalse(mock_key.called)
+
+    @mock.patch('os_vif.objects.register_all')
+    def test_initialize_registers_objects_once(self, mock_register):
+        os_vif._OBJECTS_REGISTERED = False
+        self.addCleanup(setattr, os_vif, '_OBJECTS_REGISTERED', False)
+        os_vif.initialize()
+        os_vif.initialize(reset=True)
+        mock_register.assert_called_once_with()
 
     def test_load_plugin(self):
         obj = DemoPlugin.load("demo")
@@ -99,14 +121,8 @@ class TestOSVIF(base.TestCase):
 
     @mock.patch.object(DemoPlugin, "plug")
     def test_plug(self, mock_plug):
-        plg = extension.Extension(name="demo",
-                                  entry_point="os-vif",
-                                  plugin=DemoPlugin,
-                                  obj=None)
-        with mock.patch('stevedore.extension.ExtensionManager.names',
-                        return_value=['foobar']),\
-                mock.patch('stevedore.extension.ExtensionManager.__getitem__',
-                           return_value=plg):
+        with mock.patch('stevedore.driver.DriverManager') as mock_DM:
+            mock_DM.return_value.driver = DemoPlugin
             os_vif.initialize()
             info = objects.instance_info.InstanceInfo()
             vif = objects.vif.VIFBridge(
@@ -114,17 +130,14 @@ class TestOSVIF(base.TestCase):
                 plugin='foobar')
             os_vif.plug(vif, info)
             mock_plug.assert_called_once_with(vif, info)
+            mock_DM.assert_called_once_with(namespace='os_vif',
+                                            name='foobar',
+                                            invoke_on_load=False)
 
     @mock.patch.object(DemoPlugin, "unplug")
     def test_unplug(self, mock_unplug):
-        plg = extension.Extension(name="demo",
-                                  entry_point="os-vif",
-                                  plugin=DemoPlugin,
-                                  obj=None)
-        with mock.patch('stevedore.extension.ExtensionManager.names',
-                        return_value=['foobar']),\
-                mock.patch('stevedore.extension.ExtensionManager.__getitem__',
-                           return_value=plg):
+        with mock.patch('stevedore.driver.DriverManager') as mock_DM:
+            mock_DM.return_value.driver = DemoPlugin
             os_vif.initialize()
             info = objects.instance_info.InstanceInfo()
             vif = objects.vif.VIFBridge(
@@ -132,3 +145,135 @@ class TestOSVIF(base.TestCase):
                 plugin='foobar')
             os_vif.unplug(vif, info)
             mock_unplug.assert_called_once_with(vif, info)
+
+    def test_plugin_loaded_on_first_use(self):
+        with mock.patch('stevedore.driver.DriverManager') as mock_DM, \
+                mock.patch.object(DemoPlugin, "load") as mock_load:
+            mock_DM.return_value.driver = DemoPlugin
+            os_vif.initialize()
+            self.assertFalse(mock_load.called)
+
+            info = objects.instance_info.InstanceInfo()
+            vif = objects.vif.VIFBridge(
+                id='9a12694f-f95e-49fa-9edb-70239aee5a2c',
+                plugin='foobar')
+            os_vif.plug(vif, info)
+            os_vif.unplug(vif, info)
+            mock_DM.assert_called_once_with(namespace='os_vif',
+                                            name='foobar',
+                                            invoke_on_load=False)
+            mock_load.assert_called_once_with('foobar')
+
+    def test_plug_no_matching_plugin(self):
+        with mock.patch('stevedore.driver.DriverManager',
+                        side_effect=stevedore_exception.NoMatches('foobar')):
+            os_vif.initialize()
+            info = objects.instance_info.InstanceInfo()
+            vif = objects.vif.VIFBridge(
+                id='9a12694f-f95e-49fa-9edb-70239aee5a2c',
+                plugin='foobar')
+            self.assertRaises(exception.NoMatchingPlugin,
+                              os_vif.plug, vif, info)
+
+    @mock.patch.object(DemoPlugin, "describe")
+    def test_host_info(self, mock_describe):
+        plg = extension.Extension(name="demo",
+                                  entry_point="os-vif",
+                                  plugin=DemoPlugin,
+                                  obj=None)
+        with mock.patch('stevedore.extension.ExtensionManager',
+                        return_value=[plg]):
+            os_vif.initialize()
+            mock_describe.return_value = objects.host_info.HostPluginInfo(
+                plugin_name='demo', vif_info=[])
+            info = os_vif.host_info()
+            self.assertEqual(1, len(info.plugin_info))
+            self.assertIn('demo', os_vif._DRIVER_CACHE)
+
+    @mock.patch.object(DemoPlugin, "plug")
+    @mock.patch.object(DemoPlugin, "describe")
+    def test_host_info_warm_start(self, mock_describe, mock_plug):
+        plg = extension.Extension(name="demo",
+                                  entry_point="os-vif",
+                                  plugin=DemoPlugin,
+                                  obj=None)
+        with mock.patch('stevedore.extension.ExtensionManager',
+                        return_value=[plg]):
+            os_vif.initialize()
+            mock_describe.return_value = objects.host_info.HostPluginInfo(
+                plugin_name='demo', vif_info=[])
+            os_vif.host_info()
+
+        # A fresh process finds the plugin from the cache file alone
+        with mock.patch('stevedore.extension.ExtensionManager') as mock_EM, \
+                mock.patch('stevedore.driver.DriverManager') as mock_DM:
+            os_vif.initialize(reset=True)
+            info = os_vif.host_info()
+            self.assertEqual(
+                {'demo': 'os_vif.tests.test_os_vif:DemoPlugin'},
+                os_vif._PLUGIN_CLASSES)
+            vif = objects.vif.VIFBridge(
+                id='9a12694f-f95e-49fa-9edb-70239aee5a2c',
+                plugin='demo')
+            os_vif.plug(vif, objects.instance_info.InstanceInfo())
+            self.assertEqual(1, len(info.plugin_info))
+            self.assertFalse(mock_EM.called)
+            self.assertFalse(mock_DM.called)
+            self.assertTrue(mock_plug.called)
+
+    def test_plugin_cache_invalidated(self):
+        with mock.patch('stevedore.extension.ExtensionManager',
+                        return_value=[]):
+            os_vif.initialize()
+            os_vif.host_info()
+
+        with mock.patch.object(os_vif, '_plugin_cache_key',
+                               return_value='changed'):
+            os_vif.initialize(reset=True)
+            os_vif._load_plugin_cache()
+            self.assertIsNone(os_vif._PLUGIN_CLASSES)
+
+    @mock.patch.object(DemoPlugin, "describe")
+    def test_host_info_stale_cache(self, mock_describe):
+        with mock.patch.object(os_vif, '_plugin_cache_key',
+                               return_value='key'):
+            os_vif._write_plugin_cache('key',
+                                       {'gone': 'no_such_mod:Plugin'})
+            plg = extension.Extension(name="demo",
+                                      entry_point="os-vif",
+                                      plugin=DemoPlugin,
+                                      obj=None)
+            with mock.patch('stevedore.extension.ExtensionManager',
+                            return_value=[plg]), \
+                    mock.patch('stevedore.driver.DriverManager',
+                               side_effect=stevedore_exception.NoMatches):
+                os_vif.initialize()
+                mock_describe.return_value = (
+                    objects.host_info.HostPluginInfo(plugin_name='demo',
+                                                     vif_info=[]))
+                info = os_vif.host_info()
+
+            self.assertEqual(1, len(info.plugin_info))
+            self.assertEqual(
+                {'demo': 'os_vif.tests.test_os_vif:DemoPlugin'},
+                os_vif._PLUGIN_CLASSES)
+            self.assertEqual(os_vif._PLUGIN_CLASSES,
+                             os_vif._read_plugin_cache('key'))
+
+    def test_plugin_cache_key_follows_entry_points(self):
+        site = self.useFixture(fixtures.TempDir()).path
+        egg_info = os.path.join(site, 'demo.egg-info')
+        os.mkdir(egg_info)
+        entry_points = os.path.join(egg_info, 'entry_points.txt')
+        with open(entry_points, 'w') as f:
+            f.write('[os_vif]\ndemo = demo:Plugin\n')
+        os.utime(egg_info, (0, 0))
+        os.utime(entry_points, (0, 0))
+        self.useFixture(fixtures.MonkeyPatch('sys.path', [site]))
+        key = os_vif._plugin_cache_key()
+
+        # Rewritten in place, as 'setup.py develop' does
+        with open(entry_points, 'w') as f:
+            f.write('[os_vif]\ndemo = demo:Plugin\nother = demo:Other\n')
+        os.utime(egg_info, (0, 0))
+        self.assertNotEqual(key, os_vif._plugin_cache_key())
@@ -19,33 +19,133 @@
 
 """Implements vlans, bridges, and iptables rules using linux utilities."""
 
+import contextlib
 import os
+import re
+import socket
+import threading
+import time
 
 from oslo_concurrency import lockutils
 from oslo_concurrency import processutils
 from oslo_log import log as logging
 
+from os_vif.i18n import _
+from os_vif.i18n import _LW
+
+from vif_plug_linux_bridge import privsep
+
 LOG = logging.getLogger(__name__)
+
+# pyroute2's IPRoute class, imported on first use since only the privsep
+# daemon reads routes; False until then, None if pyroute2 is missing.
+_IPROUTE = False
+
+# Kernel constants used when reading routes and addresses over netlink
+_RT_TABLE_MAIN = 254
+_RT_SCOPE_UNIVERSE = 0
+_RTPROT_BOOT = 3
+_RTNH_F_ONLINK = 4
+
+# brctl addif error for an interface that is already enslaved
+_ALREADY_MEMBER_RE = re.compile(r"device \S+ is already a member of a bridge;")
+
+# Names that are safe to put on an 'ip -batch' line: at most
+# IFNAMSIZ - 1 characters, no whitespace and no '/'.
+_NETDEV_NAME_RE = re.compile(r'\A[^\s/]{1,15}\Z')
+
+# Fixed leading argv of the ip commands run for every VLAN; callers
+# append only the device specific tokens.
+_IP_LINK_ADD = ('ip', 'link', 'add', 'link')
+_IP_LINK_SET = ('ip', 'link', 'set')
+
+# Devices only change when we (or another agent) plug or unplug
+# something, so a directory listing is reused for a short while rather
+# than stat()ing sysfs for every lookup.
+_NETDEV_CACHE_TTL = 1
+_NETDEV_CACHE = None
+_NETDEV_CACHE_TS = 0
 _IPTABLES_MANAGER = None
 
+# Per-thread nesting depth of batched_plug() blocks, and whether
+# ensure_bridge() has changed iptables rules that still need applying.
+# Kept here rather than on the iptables manager, which configure() may
+# replace mid-batch.  The depth is per thread (greenthread under
+# eventlet) so plugs made outside a block elsewhere still apply
+# synchronously.
+_BATCH_STATE = threading.local()
+_PENDING_APPLY = False
+
+
+def _get_net_devices():
+    """Return the set of network device names, listing sysfs at most
+    once per _NETDEV_CACHE_TTL seconds.
+    """
+    global _NETDEV_CACHE
+    global _NETDEV_CACHE_TS
+    now = time.time()
+    if _NETDEV_CACHE is None or now - _NETDEV_CACHE_TS > _NETDEV_CACHE_TTL:
+        _NETDEV_CACHE = set(os.listdir('/sys/class/net'))
+        _NETDEV_CACHE_TS = now
+    return _NETDEV_CACHE
+
+
+def invalidate_device_cache():
+    """Forget the cached device list after devices are added or removed."""
+    global _NETDEV_CACHE
+    _NETDEV_CACHE = None
+
 
 def device_exists(device):
     """Check if ethernet device exists."""
-    return os.path.exists('/sys/class/net/%s' % device)
+    return device in _get_net_devices()
+
+
+def _get_device_mtu(dev):
+    """Return the current MTU of a device, or None if it can't be read."""
+    try:
+        with open('/sys/class/net/%s/mtu' % dev) as f:
+            return int(f.read().strip())
+    except (IOError, OSError, ValueError):
+        return None
 
 
 def _set_device_mtu(dev, mtu):
     """Set the device MTU."""
-    processutils.execute('ip', 'link', 'set', dev, 'mtu', mtu,
+    processutils.execute(*(_IP_LINK_SET + (dev, 'mtu', mtu)),
                          check_exit_code=[0, 2, 254])
 
 
+def _validate_device_name(name):
+    """Raise unless name is a valid network device name."""
+    if not _NETDEV_NAME_RE.match(name) or name in ('.', '..'):
+        msg = _('Invalid network device name: %r') % name
+        raise Exception(msg)
+
+
+def _set_bridge_option(bridge, option, value):
+    """Set a bridge option through sysfs, as brctl does."""
+    with open('/sys/class/net/%s/bridge/%s' % (bridge, option), 'w') as f:
+        f.write(value)
+
+
 def _ip_bridge_cmd(action, params, device):
-    """Build commands to add/del ips to bridges/devices."""
-    cmd = ['ip', 'addr', action]
+    """Build 'ip -batch' commands to add/del ips to bridges/devices."""
+    cmd = ['addr', action]
     cmd.extend(params)
     cmd.extend(['dev', device])
-    return cmd
+    return ' '.join(cmd)
+
+
+def _execute_ip_batch(commands, force=False, **kwargs):
+    """Run a list of ip commands in a single 'ip -batch' process."""
+    cmd = ['ip']
+    if force:
+        cmd.append('-force')
+    cmd.extend(['-batch', '-'])
+    return processutils.execute(*cmd,
+                                process_input='\n'.join(commands) + '\n',
+                                **kwargs)
 
 
 def ensure_vlan_bridge(vlan_num, bridge, bridge_interface,
@@ -60,30 +160,142 @@ def ensure_vlan_bridge(vlan_num, bridge, bridge_interface,
 @lockutils.synchronized('nova-lock_vlan', external=True)
 def ensure_vlan(vlan_num, bridge_interface, mac_address=None, mtu=None):
     """Create a vlan unless it already exists."""
+    return _ensure_vlan_privileged(vlan_num, bridge_interface,
+                                   mac_address, mtu)
+
+
+@privsep.vif_plug.entrypoint
+def _ensure_vlan_privileged(vlan_num, bridge_interface, mac_address, mtu):
+    """Create a vlan unless it already exists.
+
+    This function will be executed with elevated privileges.
+    """
     interface = 'vlan%s' % vlan_num
     if not device_exists(interface):
         LOG.debug('Starting VLAN interface %s', interface)
-        processutils.execute('ip', 'link', 'add', 'link',
-                             bridge_interface, 'name', interface, 'type',
-                             'vlan', 'id', vlan_num,
-                             check_exit_code=[0, 2, 254],
-                             run_as_root=True)
+        processutils.execute(*(_IP_LINK_ADD +
+                               (bridge_interface, 'name', interface,
+                                'type', 'vlan', 'id', vlan_num)),
+                             check_exit_code=[0, 2, 254])
+        invalidate_device_cache()
         # (danwent) the bridge will inherit this address, so we want to
         # make sure it is the value set from the NetworkManager
         if mac_address:
-            processutils.execute('ip', 'link', 'set', interface,
-                                 'address', mac_address,
-                                 check_exit_code=[0, 2, 254],
-                                 run_as_root=True)
-        processutils.execute('ip', 'link', 'set', interface, 'up',
-                             check_exit_code=[0, 2, 254],
-                             run_as_root=True)
+            processutils.execute(*(_IP_LINK_SET +
+                                   (interface, 'address', mac_address)),
+                                 check_exit_code=[0, 2, 254])
+        processutils.execute(*(_IP_LINK_SET + (interface, 'up')),
+                             check_exit_code=[0, 2, 254])
     # NOTE(vish): set mtu every time to ensure that changes to mtu get
-    #             propogated
-    _set_device_mtu(interface, mtu)
+    #             propogated, but skip the ip call when no mtu was given
+    #             or sysfs already reports the wanted value.
+    if mtu and _get_device_mtu(interface) != int(mtu):
+        _set_device_mtu(interface, mtu)
     return interface
 
 
+def _get_routes_and_addrs(interface):
+    """Get the gateway routes and global IPv4 addresses of an interface.
+
+    :param interface: the name of the interface to inspect.
+    :returns: a tuple of (routes, addrs), where each route is a list of
+              'ip route' arguments and each addr is a tuple of
+              ('ip addr' arguments, device).
+    """
+    global _IPROUTE
+    if _IPROUTE is False:
+        try:
+            from pyroute2 import IPRoute
+            _IPROUTE = IPRoute
+        except ImportError:
+            _IPROUTE = None
+    if _IPROUTE is None:
+        return _get_routes_and_addrs_cmd(interface)
+    return _get_routes_and_addrs_netlink(interface)
+
+
+def _get_routes_and_addrs_cmd(interface):
+    # Both listings come from one ip process; address lines are the
+    # only ones starting with 'inet', and 'ip route show dev' always
+    # prints the gateway as '<dst> via <gw>'.
+    out, err = _execute_ip_batch(
+        ['route show dev %s' % interface,
+         'addr show dev %s scope global' % interface])
+    routes = []
+    addrs = []
+    for line in out.splitlines():
+        fields = line.split()
+        if not fields:
+            continue
+        if fields[0] == 'inet':
+            if fields[-2] in ('secondary', 'dynamic', ):
+                params = fields[1:-2]
+            else:
+                params = fields[1:-1]
+            addrs.append((params, fields[-1]))
+        elif fields[1:2] == ['via']:
+            routes.append(fields)
+    return routes, addrs
+
+
+def _get_routes_and_addrs_netlink(interface):
+    ipr = _IPROUTE()
+    try:
+        links = ipr.link_lookup(ifname=interface)
+        if not links:
+            return [], []
+        index = links[0]
+
+        routes = []
+        for msg in ipr.get_routes(family=socket.AF_INET, oif=index):
+            gateway = msg.get_attr('RTA_GATEWAY')
+            table = msg.get_attr('RTA_TABLE', msg['table'])
+            if not gateway or table != _RT_TABLE_MAIN:
+                continue
+            dst = msg.get_attr('RTA_DST')
+            if dst:
+                fields = ['%s/%s' % (dst, msg['dst_len'])]
+            else:
+                fields = ['default']
+            fields.extend(['via', gateway])
+            # NOTE: same attributes, in the same order, as
+            # 'ip route show' prints them.
+            if msg['proto'] != _RTPROT_BOOT:
+                fields.extend(['proto', str(msg['proto'])])
+            if msg['scope'] != _RT_SCOPE_UNIVERSE:
+                fields.extend(['scope', str(msg['scope'])])
+            prefsrc = msg.get_attr('RTA_PREFSRC')
+            if prefsrc:
+                fields.extend(['src', prefsrc])
+            metric = msg.get_attr('RTA_PRIORITY')
+            if metric:
+                fields.extend(['metric', str(metric)])
+            if msg['flags'] & _RTNH_F_ONLINK:
+                fields.append('onlink')
+            routes.append(fields)
+
+        addrs = []
+        for msg in ipr.get_addr(family=socket.AF_INET, index=index):
+            if msg['scope'] != _RT_SCOPE_UNIVERSE:
+                continue
+            local = msg.get_attr('IFA_LOCAL')
+            address = msg.get_attr('IFA_ADDRESS')
+            if local and address and local != address:
+                # point-to-point: IFA_ADDRESS is the peer
+                params = [local, 'peer',
+                          '%s/%s' % (address, msg['prefixlen'])]
+            else:
+                params = ['%s/%s' % (local or address, msg['prefixlen'])]
+            broadcast = msg.get_attr('IFA_BROADCAST')
+            if broadcast:
+                params.extend(['brd', broadcast])
+            params.extend(['scope', 'global'])
+            addrs.append((params, msg.get_attr('IFA_LABEL') or interface))
+        return routes, addrs
+    finally:
+        ipr.close()
+
+
 @lockutils.synchronized('nova-lock_bridge', external=True)
 def ensure_bridge(bridge, interface, net_attrs=None, gateway=True,
                   filtering=True):
@@ -102,75 +314,11 @@ def ensure_bridge(bridge, interface, net_attrs=None, gateway=True,
     interface onto the bridge and reset the default gateway if necessary.
 
     """
-    if not device_exists(bridge):
-        LOG.debug('Starting Bridge %s', bridge)
-        processutils.execute('brctl', 'addbr', bridge,
-                             run_as_root=True)
-        processutils.execute('brctl', 'setfd', bridge, 0,
-                             run_as_root=True)
-        # processutils.execute('brctl setageing %s 10' % bridge,
-        #                      run_as_root=True)
-        processutils.execute('brctl', 'stp', bridge, 'off',
-                             run_as_root=True)
-        # (danwent) bridge device MAC address can't be set directly.
-        # instead it inherits the MAC address of the first device on the
-        # bridge, which will either be the vlan interface, or a
-        # physical NIC.
-        processutils.execute('ip', 'link', 'set', bridge, 'up',
-                             run_as_root=True)
-
-    if interface:
-        LOG.debug('Adding interface %(interface)s to bridge %(bridge)s',
-                  {'interface': interface, 'bridge': bridge})
-        out, err = processutils.execute('brctl', 'addif', bridge,
-                                        interface, check_exit_code=False,
-                                        run_as_root=True)
-        if (err and err != "device %s is already a member of a bridge; "
-              "can't enslave it to bridge %s.\n" % (interface, bridge)):
-            msg = _('Failed to add interface: %s') % err
-            raise Exception(msg)
-
-        out, err = processutils.execute('ip', 'link', 'set',
-                                        interface, 'up', check_exit_code=False,
-                                        run_as_root=True)
-
-        # NOTE(vish): This will break if there is already an ip on the
-        #             interface, so we move any ips to the bridge
-        # NOTE(danms): We also need to copy routes to the bridge so as
-        #              not to break existing connectivity on the interface
-        old_routes = []
-        out, err = processutils.execute('ip', 'route', 'show', 'dev',
-                                        interface)
-        for line in out.split('\n'):
-            fields = line.split()
-            if fields and 'via' in fields:
-                old_routes.append(fields)
-                processutils.execute('ip', 'route', 'del', *fields,
-                                     run_as_root=True)
-        out, err = processutils.execute('ip', 'addr', 'show', 'dev', interface,
-                                        'scope', 'global')
-        for line in out.split('\n'):
-            fields = line.split()
-            if fields and fields[0] == 'inet':
-                if fields[-2] in ('secondary', 'dynamic', ):
-                    params = fields[1:-2]
-                else:
-                    params = fields[1:-1]
-                processutils.execute(*_ip_bridge_cmd('del', params,
-                                                     fields[-1]),
-                                     check_exit_code=[0, 2, 254],
-                                     run_as_root=True)
-                processutils.execute(*_ip_bridge_cmd('add', params,
-                                                     bridge),
-                                     check_exit_code=[0, 2, 254],
-                                     run_as_root=True)
-        for fields in old_routes:
-            processutils.execute('ip', 'route', 'add', *fields,
-                                 run_as_root=True)
+    _ensure_bridge_privileged(bridge, interface)
 
     if filtering:
         # Don't forward traffic unless we were told to be a gateway
-        global _IPTABLES_MANAGER
+        global _PENDING_APPLY
         ipv4_filter = _IPTABLES_MANAGER.ipv4['filter']
         if gateway:
             for rule in _IPTABLES_MANAGER.get_gateway_rules(bridge):
@@ -184,9 +332,120 @@ def ensure_bridge(bridge, interface, net_attrs=None, gateway=True,
                                  ('--out-interface %s -j %s'
                                   % (bridge,
                                      _IPTABLES_MANAGER.iptables_drop_action)))
+        if _batch_depth():
+            _PENDING_APPLY = True
+        else:
+            _IPTABLES_MANAGER.apply()
+
+
+@privsep.vif_plug.entrypoint
+def _ensure_bridge_privileged(bridge, interface):
+    """Create a bridge and move the interface onto it.
+
+    This function will be executed with elevated privileges.
+    """
+    _validate_device_name(bridge)
+    if interface:
+        _validate_device_name(interface)
+
+    if not device_exists(bridge):
+        LOG.debug('Starting Bridge %s', bridge)
+        # (danwent) bridge device MAC address can't be set directly.
+        # instead it inherits the MAC address of the first device on the
+        # bridge, which will either be the vlan interface, or a
+        # physical NIC.
+        _execute_ip_batch(['link add name %s type bridge' % bridge,
+                           'link set %s up' % bridge])
+        invalidate_device_cache()
+        # NOTE: through sysfs rather than 'type bridge forward_delay 0
+        # stp_state 0', which older iproute2 rejects.
+        _set_bridge_option(bridge, 'forward_delay', '0')
+        _set_bridge_option(bridge, 'stp_state', '0')
+
+    if interface:
+        if not os.path.exists('/sys/class/net/%s/brif/%s' %
+                              (bridge, interface)):
+            LOG.debug('Adding interface %(interface)s to bridge %(bridge)s',
+                      {'interface': interface, 'bridge': bridge})
+            out, err = processutils.execute('brctl', 'addif', bridge,
+                                            interface, check_exit_code=False)
+            if err and not _ALREADY_MEMBER_RE.match(err):
+                msg = _('Failed to add interface: %s') % err
+                raise Exception(msg)
+
+        # NOTE(vish): This will break if there is already an ip on the
+        #             interface, so we move any ips to the bridge
+        # NOTE(danms): We also need to copy routes to the bridge so as
+        #              not to break existing connectivity on the interface
+        old_routes, old_addrs = _get_routes_and_addrs(interface)
+
+        # NOTE: a failed route change must still fail the plug, so routes
+        # are moved in strict batches around the tolerant address move.
+        if old_routes:
+            _execute_ip_batch(['route del %s' % ' '.join(fields)
+                               for fields in old_routes])
+
+        cmds = ['link set %s up' % interface]
+        for params, device in old_addrs:
+            cmds.append(_ip_bridge_cmd('del', params, device))
+            cmds.append(_ip_bridge_cmd('add', params, bridge))
+
+        # NOTE: with -force ip carries on past a failing command and
+        # exits with 1, so the rest of the addresses are still moved.
+        out, err = _execute_ip_batch(cmds, force=True,
+                                     check_exit_code=[0, 1])
+        if err:
+            LOG.warning(_LW('Failed to move addresses from %(interface)s '
+                            'to bridge %(bridge)s: %(err)s'),
+                        {'interface': interface, 'bridge': bridge,
+                         'err': err})
+
+        if old_routes:
+            _execute_ip_batch(['route add %s' % ' '.join(fields)
+                               for fields in old_routes])
+
+
+def _batch_depth():
+    return getattr(_BATCH_STATE, 'depth', 0)
+
+
+def flush_iptables():
+    """Apply iptables rules left pending by ensure_bridge()."""
+    global _PENDING_APPLY
+    if _PENDING_APPLY and _IPTABLES_MANAGER is not None:
+        _PENDING_APPLY = False
         _IPTABLES_MANAGER.apply()
 
 
+@contextlib.contextmanager
+def batched_plug():
+    """Defer applying iptables rules until the end of the block.
+
+    Bridges set up with ensure_bridge() inside the block, in the same
+    thread, only update the in-memory rules, which are then applied
+    with a single iptables-restore when the outermost block exits.  The
+    block may be entered before any plugin has been loaded.
+    """
+    _BATCH_STATE.depth = _batch_depth() + 1
+    try:
+        yield
+    finally:
+        _BATCH_STATE.depth -= 1
+        if not _BATCH_STATE.depth:
+            flush_iptables()
+
+
+def ensure_bridge_batch(items):
+    """Create several bridges, applying iptables rules only once.
+
+    :param items: an iterable of (bridge, interface) tuples, passed to
+                  ensure_bridge() in order.
+    """
+    with batched_plug():
+        for bridge, interface in items:
+            ensure_bridge(bridge, interface)
+
+
 def configure(iptables_mgr):
     """Configure the iptables manager impl.
 
@@ -0,0 +1,360 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import os
+import testtools
+import threading
+
+from oslo_concurrency.fixture import lockutils as lock_fixture
+from oslo_concurrency import processutils
+
+from vif_plug_linux_bridge import iptables
+from vif_plug_linux_bridge import linux_net
+from vif_plug_linux_bridge import privsep
+
+
+def _msg(fields, attrs):
+    """Fake a pyroute2 netlink message."""
+    msg = mock.MagicMock()
+    msg.__getitem__.side_effect = fields.__getitem__
+    msg.get_attr.side_effect = lambda name, default=None: (
+        attrs.get(name, default))
+    return msg
+
+
+class LinuxNetTest(testtools.TestCase):
+
+    def setUp(self):
+        super(LinuxNetTest, self).setUp()
+        self.useFixture(lock_fixture.ExternalLockFixture())
+        privsep.vif_plug.set_client_mode(False)
+        self.addCleanup(privsep.vif_plug.set_client_mode, True)
+        linux_net.invalidate_device_cache()
+        self.addCleanup(linux_net.invalidate_device_cache)
+
+    @mock.patch.object(os, "listdir", return_value=['lo', 'eth0'])
+    def test_device_exists_lists_sysfs_once(self, mock_listdir):
+        self.assertTrue(linux_net.device_exists('eth0'))
+        self.assertFalse(linux_net.device_exists('br0'))
+        mock_listdir.assert_called_once_with('/sys/class/net')
+
+        linux_net.invalidate_device_cache()
+        mock_listdir.return_value = ['lo', 'eth0', 'br0']
+        self.assertTrue(linux_net.device_exists('br0'))
+        self.assertEqual(2, mock_listdir.call_count)
+
+    @mock.patch.object(linux_net, "_set_bridge_option")
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=False)
+    def test_ensure_bridge_new(self, mock_dev_exists, mock_exec,
+                               mock_set_option):
+        linux_net.ensure_bridge("br0", None, filtering=False)
+
+        mock_exec.assert_called_once_with(
+            'ip', '-batch', '-',
+            process_input=('link add name br0 type bridge\n'
+                           'link set br0 up\n'))
+        self.assertEqual([mock.call('br0', 'forward_delay', '0'),
+                          mock.call('br0', 'stp_state', '0')],
+                         mock_set_option.call_args_list)
+
+    @mock.patch.object(linux_net, "_get_routes_and_addrs",
+                       return_value=([], []))
+    @mock.patch.object(os.path, "exists", return_value=True)
+    @mock.patch.object(processutils, "execute", return_value=('', ''))
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_ensure_bridge_interface_already_added(self, mock_dev_exists,
+                                                   mock_exec, mock_exists,
+                                                   mock_get):
+        linux_net.ensure_bridge("br0", "eth0", filtering=False)
+
+        mock_exists.assert_any_call('/sys/class/net/br0/brif/eth0')
+        mock_exec.assert_called_once_with(
+            'ip', '-force', '-batch', '-',
+            process_input='link set eth0 up\n',
+            check_exit_code=[0, 1])
+
+    @mock.patch.object(linux_net, "_IPROUTE", None)
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_ensure_bridge_moves_ips_in_one_batch(self, mock_dev_exists,
+                                                  mock_exec):
+        mock_exec.side_effect = [
+            ('', ''),
+            ('default via 192.168.0.1 proto static\n'
+             '192.168.0.0/24 proto kernel scope link src 192.168.0.2\n'
+             '2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500\n'
+             '    inet 192.168.0.2/24 brd 192.168.0.255 scope global eth0\n'
+             '    inet 192.168.0.3/24 scope global secondary eth0\n', ''),
+            ('', ''),
+            ('', ''),
+            ('', ''),
+        ]
+
+        linux_net.ensure_bridge("br0", "eth0", filtering=False)
+
+        self.assertEqual([
+            mock.call('ip', '-batch', '-',
+                      process_input=('route show dev eth0\n'
+                                     'addr show dev eth0 scope global\n')),
+            mock.call('ip', '-batch', '-',
+                      process_input=('route del default via 192.168.0.1 '
+                                     'proto static\n')),
+            mock.call('ip', '-force', '-batch', '-',
+                      process_input=(
+                          'link set eth0 up\n'
+                          'addr del 192.168.0.2/24 brd 192.168.0.255 '
+                          'scope global dev eth0\n'
+                          'addr add 192.168.0.2/24 brd 192.168.0.255 '
+                          'scope global dev br0\n'
+                          'addr del 192.168.0.3/24 scope global dev eth0\n'
+                          'addr add 192.168.0.3/24 scope global dev br0\n'),
+                      check_exit_code=[0, 1]),
+            mock.call('ip', '-batch', '-',
+                      process_input=('route add default via 192.168.0.1 '
+                                     'proto static\n')),
+        ], mock_exec.call_args_list[1:])
+
+    @mock.patch.object(linux_net, "_get_routes_and_addrs",
+                       return_value=([['default', 'via', '192.168.0.1']],
+                                     [(['192.168.0.2/24'], 'eth0')]))
+    @mock.patch.object(os.path, "exists", return_value=True)
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_ensure_bridge_route_add_failure(self, mock_dev_exists,
+                                             mock_exec, mock_exists,
+                                             mock_get):
+        mock_exec.side_effect = [
+            ('', ''),
+            ('', 'RTNETLINK answers: File exists\n'),
+            processutils.ProcessExecutionError(exit_code=2),
+        ]
+        self.assertRaises(processutils.ProcessExecutionError,
+                          linux_net.ensure_bridge, "br0", "eth0",
+                          filtering=False)
+        self.assertEqual(3, mock_exec.call_count)
+
+    @mock.patch.object(linux_net, "_IPROUTE")
+    def test_get_routes_and_addrs_netlink(self, mock_iproute):
+        ipr = mock_iproute.return_value
+        ipr.link_lookup.return_value = [2]
+        ipr.get_routes.return_value = [
+            _msg({'table': 254, 'dst_len': 0, 'proto': 4, 'scope': 0,
+                  'flags': 0},
+                 {'RTA_GATEWAY': '192.168.0.1'}),
+            _msg({'table': 254, 'dst_len': 24, 'proto': 2, 'scope': 253,
+                  'flags': 0},
+                 {'RTA_DST': '192.168.0.0'}),
+        ]
+        ipr.get_addr.return_value = [
+            _msg({'scope': 0, 'prefixlen': 24},
+                 {'IFA_LOCAL': '192.168.0.2',
+                  'IFA_BROADCAST': '192.168.0.255',
+                  'IFA_LABEL': 'eth0'}),
+            _msg({'scope': 254, 'prefixlen': 8},
+                 {'IFA_LOCAL': '127.0.0.1'}),
+        ]
+
+        routes, addrs = linux_net._get_routes_and_addrs("eth0")
+
+        self.assertEqual([['default', 'via', '192.168.0.1', 'proto', '4']],
+                         routes)
+        self.assertEqual([(['192.168.0.2/24', 'brd', '192.168.0.255',
+                            'scope', 'global'], 'eth0')], addrs)
+        ipr.close.assert_called_once_with()
+
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "_IPROUTE")
+    def test_get_routes_and_addrs_paths_agree(self, mock_iproute,
+                                              mock_exec):
+        mock_exec.return_value = (
+            'default via 10.0.0.1 src 10.0.0.5 metric 100 onlink\n'
+            '2: eth0: <POINTOPOINT,UP,LOWER_UP> mtu 1500\n'
+            '    inet 10.0.0.5 peer 10.0.0.1/32 scope global eth0\n', '')
+        ipr = mock_iproute.return_value
+        ipr.link_lookup.return_value = [2]
+        ipr.get_routes.return_value = [
+            _msg({'table': 254, 'dst_len': 0, 'proto': 3, 'scope': 0,
+                  'flags': 4},
+                 {'RTA_GATEWAY': '10.0.0.1', 'RTA_PREFSRC': '10.0.0.5',
+                  'RTA_PRIORITY': 100}),
+        ]
+        ipr.get_addr.return_value = [
+            _msg({'scope': 0, 'prefixlen': 32},
+                 {'IFA_LOCAL': '10.0.0.5', 'IFA_ADDRESS': '10.0.0.1',
+                  'IFA_LABEL': 'eth0'}),
+        ]
+
+        from_cmd = linux_net._get_routes_and_addrs_cmd("eth0")
+        from_netlink = linux_net._get_routes_and_addrs_netlink("eth0")
+
+        self.assertEqual(
+            ([['default', 'via', '10.0.0.1', 'src', '10.0.0.5',
+               'metric', '100', 'onlink']],
+             [(['10.0.0.5', 'peer', '10.0.0.1/32', 'scope', 'global'],
+               'eth0')]),
+            from_cmd)
+        self.assertEqual(from_cmd, from_netlink)
+
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_batched_plug_applies_iptables_once(self, mock_dev_exists):
+        ipm = iptables.IptablesManager()
+        self.addCleanup(linux_net.configure, linux_net._IPTABLES_MANAGER)
+        linux_net.configure(ipm)
+
+        with mock.patch.object(ipm, "_apply") as mock_apply:
+            with linux_net.batched_plug():
+                linux_net.ensure_bridge("br0", None)
+                with linux_net.batched_plug():
+                    linux_net.ensure_bridge("br1", None)
+                self.assertFalse(mock_apply.called)
+            mock_apply.assert_called_once_with()
+
+            linux_net.ensure_bridge("br2", None)
+            self.assertEqual(2, mock_apply.call_count)
+
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_batched_plug_before_configure(self, mock_dev_exists):
+        self.addCleanup(linux_net.configure, linux_net._IPTABLES_MANAGER)
+        linux_net.configure(None)
+        ipm1 = iptables.IptablesManager()
+        ipm2 = iptables.IptablesManager()
+
+        with mock.patch.object(ipm1, "_apply") as mock_apply1, \
+                mock.patch.object(ipm2, "_apply") as mock_apply2:
+            with linux_net.batched_plug():
+                # The plugin, and so the manager, is only set up by the
+                # first plug inside the block and may be replaced by a
+                # later initialize(reset=True).
+                linux_net.configure(ipm1)
+                linux_net.ensure_bridge("br0", None)
+                linux_net.configure(ipm2)
+                linux_net.ensure_bridge("br1", None)
+                self.assertFalse(mock_apply1.called)
+                self.assertFalse(mock_apply2.called)
+            self.assertFalse(mock_apply1.called)
+            mock_apply2.assert_called_once_with()
+
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_batched_plug_other_thread_applies(self, mock_dev_exists):
+        ipm = iptables.IptablesManager()
+        self.addCleanup(linux_net.configure, linux_net._IPTABLES_MANAGER)
+        linux_net.configure(ipm)
+
+        with mock.patch.object(ipm, "_apply") as mock_apply:
+            with linux_net.batched_plug():
+                linux_net.ensure_bridge("br0", None)
+                # A plug outside any block, from another thread, must not
+                # be held back by this thread's block.
+                thread = threading.Thread(target=linux_net.ensure_bridge,
+                                          args=("br1", None))
+                thread.start()
+                thread.join()
+                self.assertEqual(1, mock_apply.call_count)
+            self.assertEqual(2, mock_apply.call_count)
+
+    @mock.patch.object(linux_net, "ensure_bridge")
+    def test_ensure_bridge_batch(self, mock_ensure_bridge):
+        def _ensure_bridge(bridge, interface):
+            self.assertEqual(1, linux_net._batch_depth())
+        mock_ensure_bridge.side_effect = _ensure_bridge
+
+        linux_net.ensure_bridge_batch([("br0", "eth0"), ("br1", None)])
+        self.assertEqual([mock.call("br0", "eth0"), mock.call("br1", None)],
+                         mock_ensure_bridge.call_args_list)
+        self.assertEqual(0, linux_net._batch_depth())
+
+    def test_pyroute2_imported_lazily(self):
+        self.addCleanup(setattr, linux_net, '_IPROUTE',
+                        linux_net._IPROUTE)
+        linux_net._IPROUTE = False
+        with mock.patch.dict('sys.modules', {'pyroute2': None}), \
+                mock.patch.object(linux_net, "_get_routes_and_addrs_cmd",
+                                  return_value=([], [])) as mock_cmd:
+            self.assertEqual(([], []),
+                             linux_net._get_routes_and_addrs("eth0"))
+            mock_cmd.assert_called_once_with("eth0")
+        self.assertIsNone(linux_net._IPROUTE)
+
+    def test_batched_plug_nothing_pending(self):
+        self.addCleanup(linux_net.configure, linux_net._IPTABLES_MANAGER)
+        linux_net.configure(None)
+        with linux_net.batched_plug():
+            pass
+        self.assertFalse(linux_net._PENDING_APPLY)
+
+    @mock.patch.object(linux_net, "_get_routes_and_addrs",
+                       return_value=([], []))
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_ensure_bridge_addif_already_member(self, mock_dev_exists,
+                                                mock_exec, mock_get):
+        mock_exec.side_effect = [
+            ('', "device eth0 is already a member of a bridge; "
+                 "can't enslave it to bridge br0.\n"),
+            ('', ''),
+        ]
+        linux_net.ensure_bridge("br0", "eth0", filtering=False)
+        self.assertEqual(2, mock_exec.call_count)
+
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_ensure_bridge_addif_error(self, mock_dev_exists, mock_exec):
+        mock_exec.return_value = ('', "interface eth0 does not exist!\n")
+        with testtools.ExpectedException(Exception,
+                                         'Failed to add interface: .*'):
+            linux_net.ensure_bridge("br0", "eth0", filtering=False)
+
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=False)
+    def test_ensure_bridge_invalid_names(self, mock_dev_exists, mock_exec):
+        for bridge, interface in (('br0\nlink delete eth0', None),
+                                  ('br0', 'eth0 up\nroute flush all'),
+                                  ('a' * 16, None)):
+            with testtools.ExpectedException(Exception,
+                                             'Invalid network device name'):
+                linux_net.ensure_bridge(bridge, interface, filtering=False)
+        self.assertFalse(mock_exec.called)
+
+    @mock.patch.object(linux_net, "_get_device_mtu", return_value=1500)
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_ensure_vlan_mtu_unchanged(self, mock_dev_exists, mock_exec,
+                                       mock_get_mtu):
+        self.assertEqual('vlan99',
+                         linux_net.ensure_vlan(99, 'eth0', mtu=1500))
+        mock_get_mtu.assert_called_once_with('vlan99')
+        self.assertFalse(mock_exec.called)
+
+    @mock.patch.object(linux_net, "_get_device_mtu", return_value=1500)
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=True)
+    def test_ensure_vlan_mtu_changed(self, mock_dev_exists, mock_exec,
+                                     mock_get_mtu):
+        linux_net.ensure_vlan(99, 'eth0', mtu=9000)
+        mock_exec.assert_called_once_with('ip', 'link', 'set', 'vlan99',
+                                          'mtu', 9000,
+                                          check_exit_code=[0, 2, 254])
+
+    @mock.patch.object(processutils, "execute")
+    @mock.patch.object(linux_net, "device_exists", return_value=False)
+    def test_ensure_vlan_new(self, mock_dev_exists, mock_exec):
+        linux_net.ensure_vlan(99, 'eth0', mac_address='ca:fe:de:ad:be:ef')
+        self.assertEqual([
+            mock.call('ip', 'link', 'add', 'link', 'eth0', 'name', 'vlan99',
+                      'type', 'vlan', 'id', 99, check_exit_code=[0, 2, 254]),
+            mock.call('ip', 'link', 'set', 'vlan99', 'address',
+                      'ca:fe:de:ad:be:ef', check_exit_code=[0, 2, 254]),
+            mock.call('ip', 'link', 'set', 'vlan99', 'up',
+                      check_exit_code=[0, 2, 254])],
+            mock_exec.call_args_list)
@@ -26,3 +26,7 @@ class MissingPortProfile(osv_exception.ExceptionBase):
 class WrongPortProfile(osv_exception.ExceptionBase):
     msg_fmt = _('Port profile %(profile)s is not a subclass '
                 'of VIFPortProfileOpenVSwitch')
+
+
+class InvalidDeviceName(osv_exception.ExceptionBase):
+    msg_fmt = _('Invalid network device name %(name)r')
@@ -20,6 +20,8 @@
 """Implements vlans, bridges using linux utilities."""
 
 import os
+import re
+import time
 
 from oslo_concurrency import processutils
 from oslo_log import log as logging
@@ -27,9 +29,28 @@ from oslo_utils import excutils
 
 from vif_plug_ovs import exception
 from vif_plug_ovs.i18n import _LE
+from vif_plug_ovs.i18n import _LW
+from vif_plug_ovs import privsep
 
 LOG = logging.getLogger(__name__)
 
+# Names that are safe to put on an 'ip -batch' line or in a sysfs path:
+# at most IFNAMSIZ - 1 characters, no whitespace and no '/'.
+_NETDEV_NAME_RE = re.compile(r'\A[^\s/]{1,15}\Z')
+
+# Devices only change when we (or another agent) plug or unplug
+# something, so a directory listing is reused for a short while rather
+# than stat()ing sysfs for every lookup.
+_NETDEV_CACHE_TTL = 1
+_NETDEV_CACHE = None
+_NETDEV_CACHE_TS = 0
+
+
+def _validate_device_name(name):
+    """Raise InvalidDeviceName unless name is a valid network device name."""
+    if not _NETDEV_NAME_RE.match(name) or name in ('.', '..'):
+        raise exception.InvalidDeviceName(name=name)
+
 
 def _ovs_vsctl(args, timeout=None):
     full_args = ['ovs-vsctl']
@@ -37,13 +58,14 @@ def _ovs_vsctl(args, timeout=None):
         full_args += ['--timeout=%s' % timeout]
     full_args += args
     try:
-        return processutils.execute(*full_args, run_as_root=True)
+        return processutils.execute(*full_args)
     except Exception as e:
         LOG.error(_LE("Unable to execute %(cmd)s. Exception: %(exception)s"),
                   {'cmd': full_args, 'exception': e})
         raise exception.AgentError(method=full_args)
 
 
+@privsep.vif_plug.entrypoint
 def create_ovs_vif_port(bridge, dev, iface_id, mac, instance_id, mtu,
                         timeout=None):
     _ovs_vsctl(['--', '--if-exists', 'del-port', dev, '--',
@@ -58,46 +80,172 @@ def create_ovs_vif_port(bridge, dev, iface_id, mac, instance_id, mtu,
 
 
 def delete_ovs_vif_port(bridge, dev, timeout=None):
+    _delete_ovs_vif_port_privileged(bridge, dev, timeout)
+    invalidate_device_cache()
+
+
+@privsep.vif_plug.entrypoint
+def _delete_ovs_vif_port_privileged(bridge, dev, timeout):
     _ovs_vsctl(['--', '--if-exists', 'del-port', bridge, dev],
                timeout=timeout)
     delete_net_dev(dev)
 
 
+def get_net_devices():
+    """Return the set of network device names, listing sysfs at most
+    once per _NETDEV_CACHE_TTL seconds.
+    """
+    global _NETDEV_CACHE
+    global _NETDEV_CACHE_TS
+    now = time.time()
+    if _NETDEV_CACHE is None or now - _NETDEV_CACHE_TS > _NETDEV_CACHE_TTL:
+        _NETDEV_CACHE = set(os.listdir('/sys/class/net'))
+        _NETDEV_CACHE_TS = now
+    return _NETDEV_CACHE
+
+
+def invalidate_device_cache():
+    """Forget the cached device list after devices are added or removed."""
+    global _NETDEV_CACHE
+    _NETDEV_CACHE = None
+
+
 def device_exists(device):
     """Check if ethernet device exists."""
-    return os.path.exists('/sys/class/net/%s' % device)
+    return device in get_net_devices()
+
+
+def read_sysfs(path):
+    """Return the stripped contents of a sysfs or procfs file, or None
+    if it cannot be read.
+    """
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _sysfs_write(path, value, check=False):
+    """Write a value to a sysfs or procfs file.
+
+    Only called from within privileged functions, with paths they built.
+    A failure is logged and ignored unless check is set.
+    """
+    try:
+        with open(path, 'w') as f:
+            f.write(value)
+    except (IOError, OSError) as e:
+        with excutils.save_and_reraise_exception(reraise=check):
+            LOG.warning(_LW("Failed to write %(value)s to %(path)s: "
+                            "%(err)s"),
+                        {'value': value, 'path': path, 'err': e})
+
+
+def create_bridge(bridge):
+    """Create a linux bridge for the hybrid plug strategy."""
+    _create_bridge_privileged(bridge)
+    invalidate_device_cache()
+
+
+@privsep.vif_plug.entrypoint
+def _create_bridge_privileged(bridge):
+    _validate_device_name(bridge)
+    processutils.execute('ip', 'link', 'add', 'name', bridge,
+                         'type', 'bridge')
+    # NOTE: bridge options are set through sysfs, as older iproute2
+    # rejects them on 'ip link add'.  Only values that differ from what
+    # the kernel gave the new bridge are written, a read is much
+    # cheaper than a write.  forward_delay and stp_state must be set,
+    # as 'brctl setfd' and 'brctl stp' had to succeed; multicast
+    # snooping and disable_ipv6 are best effort.
+    for option, check in (('forward_delay', True), ('stp_state', True),
+                          ('multicast_snooping', False)):
+        syspath = '/sys/class/net/%s/bridge/%s' % (bridge, option)
+        if read_sysfs(syspath) != '0':
+            _sysfs_write(syspath, '0', check=check)
+    disv6 = '/proc/sys/net/ipv6/conf/%s/disable_ipv6' % bridge
+    if os.path.exists(disv6) and read_sysfs(disv6) != '1':
+        _sysfs_write(disv6, '1')
+
+
+@privsep.vif_plug.entrypoint
+def add_bridge_port(bridge, dev):
+    """Bring up a bridge and add a device to it."""
+    _validate_device_name(bridge)
+    _validate_device_name(dev)
+    _execute_ip_batch(['link set %s up' % bridge,
+                       'link set %s master %s' % (dev, bridge)])
+
+
+def delete_bridge(bridge, dev):
+    """Remove a device from a bridge and delete the bridge."""
+    _delete_bridge_privileged(bridge, dev)
+    invalidate_device_cache()
+
+
+@privsep.vif_plug.entrypoint
+def _delete_bridge_privileged(bridge, dev):
+    processutils.execute('brctl', 'delif', bridge, dev)
+    processutils.execute('ip', 'link', 'set', bridge, 'down')
+    processutils.execute('brctl', 'delbr', bridge)
 
 
 def delete_net_dev(dev):
     """Delete a network device only if it exists."""
     if device_exists(dev):
-        try:
-            processutils.execute('ip', 'link', 'delete', dev,
-                                 check_exit_code=[0, 2, 254],
-                                 run_as_root=True)
-            LOG.debug("Net device removed: '%s'", dev)
-        except processutils.ProcessExecutionError:
-            with excutils.save_and_reraise_exception():
-                LOG.error(_LE("Failed removing net device: '%s'"), dev)
+        _delete_net_dev(dev)
+
+
+def _delete_net_dev(dev):
+    try:
+        processutils.execute('ip', 'link', 'delete', dev,
+                             check_exit_code=[0, 2, 254])
+        invalidate_device_cache()
+        LOG.debug("Net device removed: '%s'", dev)
+    except processutils.ProcessExecutionError:
+        with excutils.save_and_reraise_exception():
+            LOG.error(_LE("Failed removing net device: '%s'"), dev)
 
 
-def create_veth_pair(dev1_name, dev2_name, mtu):
+def create_veth_pair(dev1_name, dev2_name, mtu, netdevs=None):
     """Create a pair of veth devices with the specified names,
     deleting any previous devices with those names.
+
+    netdevs may be a set of device names the caller has already
+    listed, to save listing them again.
     """
+    if netdevs is None:
+        netdevs = get_net_devices()
+    stale = [dev for dev in (dev1_name, dev2_name) if dev in netdevs]
+    _create_veth_pair_privileged(dev1_name, dev2_name, mtu, stale)
+    invalidate_device_cache()
+
+
+@privsep.vif_plug.entrypoint
+def _create_veth_pair_privileged(dev1_name, dev2_name, mtu, stale):
     for dev in [dev1_name, dev2_name]:
-        delete_net_dev(dev)
+        _validate_device_name(dev)
+    for dev in stale:
+        _delete_net_dev(dev)
 
-    processutils.execute('ip', 'link', 'add', dev1_name,
-                         'type', 'veth', 'peer', 'name', dev2_name,
-                         run_as_root=True)
+    cmds = ['link add %s type veth peer name %s' % (dev1_name, dev2_name)]
+    for dev in [dev1_name, dev2_name]:
+        cmds.append('link set %s up' % dev)
+        cmds.append('link set %s promisc on' % dev)
+    _execute_ip_batch(cmds)
+    invalidate_device_cache()
     for dev in [dev1_name, dev2_name]:
-        processutils.execute('ip', 'link', 'set', dev, 'up',
-                             run_as_root=True)
-        processutils.execute('ip', 'link', 'set', dev, 'promisc', 'on')
         _set_device_mtu(dev, mtu)
 
 
+def _execute_ip_batch(commands, **kwargs):
+    """Run a list of ip commands in a single 'ip -batch' process."""
+    return processutils.execute('ip', '-batch', '-',
+                                process_input='\n'.join(commands) + '\n',
+                                **kwargs)
+
+
 def _set_device_mtu(dev, mtu):
     """Set the device MTU."""
     processutils.execute('ip', 'link', 'set', dev, 'mtu', mtu,
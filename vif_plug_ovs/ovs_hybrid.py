@@ -17,16 +17,18 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import os.path
 from os_vif import objects
 from os_vif import plugin
 from oslo_config import cfg
 
-from oslo_concurrency import processutils
-
 from vif_plug_ovs import exception
 from vif_plug_ovs import linux_net
 
+# Truncated veth device names, keyed by VIF id, so they are only built
+# once per VIF across plug and unplug.
+_VETH_PAIR_NAMES = {}
+_VETH_PAIR_NAMES_MAX = 4096
+
 
 class OvsHybridPlugin(plugin.PluginBase):
     """
@@ -53,8 +55,27 @@ class OvsHybridPlugin(plugin.PluginBase):
     @staticmethod
     def get_veth_pair_names(vif):
         iface_id = vif.id
-        return (("qvb%s" % iface_id)[:OvsHybridPlugin.NIC_NAME_LEN],
-                ("qvo%s" % iface_id)[:OvsHybridPlugin.NIC_NAME_LEN])
+        names = _VETH_PAIR_NAMES.get(iface_id)
+        if names is None:
+            if len(_VETH_PAIR_NAMES) >= _VETH_PAIR_NAMES_MAX:
+                _VETH_PAIR_NAMES.clear()
+            # Slice the id rather than the formatted names, so no
+            # full length intermediate strings are built.
+            stub = iface_id[:OvsHybridPlugin.NIC_NAME_LEN - 3]
+            names = ("qvb" + stub, "qvo" + stub)
+            _VETH_PAIR_NAMES[iface_id] = names
+        return names
+
+    @staticmethod
+    def _check_port_profile(vif):
+        # NOTE: hasattr() on an unset versioned object field raises
+        # NotImplementedError on python3 rather than returning False.
+        if not vif.obj_attr_is_set('port_profile'):
+            raise exception.MissingPortProfile()
+        profile = vif.port_profile
+        if not isinstance(profile, objects.vif.VIFPortProfileOpenVSwitch):
+            raise exception.WrongPortProfile(
+                profile=profile.__class__.__name__)
 
     def describe(self):
         return objects.host_info.HostPluginInfo(
@@ -75,43 +96,21 @@ class OvsHybridPlugin(plugin.PluginBase):
         VIF on the linux bridge using standard libvirt mechanisms.
         """
 
-        if not hasattr(vif, "port_profile"):
-            raise exception.MissingPortProfile()
-        if not isinstance(vif.port_profile,
-                          objects.vif.VIFPortProfileOpenVSwitch):
-            raise exception.WrongPortProfile(
-                profile=vif.port_profile.__class__.__name__)
+        self._check_port_profile(vif)
 
         v1_name, v2_name = self.get_veth_pair_names(vif)
 
-        if not linux_net.device_exists(vif.bridge_name):
-            processutils.execute('brctl', 'addbr', vif.bridge_name,
-                                 run_as_root=True)
-            processutils.execute('brctl', 'setfd', vif.bridge_name, 0,
-                                 run_as_root=True)
-            processutils.execute('brctl', 'stp', vif.bridge_name, 'off',
-                                 run_as_root=True)
-            syspath = '/sys/class/net/%s/bridge/multicast_snooping'
-            syspath = syspath % vif.bridge_name
-            processutils.execute('tee', syspath, process_input='0',
-                                 check_exit_code=[0, 1],
-                                 run_as_root=True)
-            disv6 = ('/proc/sys/net/ipv6/conf/%s/disable_ipv6' %
-                     vif.bridge_name)
-            if os.path.exists(disv6):
-                processutils.execute('tee',
-                                     disv6,
-                                     process_input='1',
-                                     run_as_root=True,
-                                     check_exit_code=[0, 1])
-
-        if not linux_net.device_exists(v2_name):
+        # One listing answers both checks; creating the bridge does not
+        # change whether the veth pair exists.
+        netdevs = linux_net.get_net_devices()
+        if vif.bridge_name not in netdevs:
+            linux_net.create_bridge(vif.bridge_name)
+
+        if v2_name not in netdevs:
             linux_net.create_veth_pair(v1_name, v2_name,
-                                       self.config.network_device_mtu)
-            processutils.execute('ip', 'link', 'set', vif.bridge_name, 'up',
-                                 run_as_root=True)
-            processutils.execute('brctl', 'addif', vif.bridge_name, v1_name,
-                                 run_as_root=True)
+                                       self.config.network_device_mtu,
+                                       netdevs=netdevs)
+            linux_net.add_bridge_port(vif.bridge_name, v1_name)
             linux_net.create_ovs_vif_port(
                 vif.network.bridge,
                 v2_name,
@@ -126,22 +125,12 @@ class OvsHybridPlugin(plugin.PluginBase):
         Unhook port from OVS, unhook port from bridge, delete
         bridge, and delete both veth devices.
         """
-        if not hasattr(vif, "port_profile"):
-            raise exception.MissingPortProfile()
-        if not isinstance(vif.port_profile,
-                          objects.vif.VIFPortProfileOpenVSwitch):
-            raise exception.WrongPortProfile(
-                profile=vif.port_profile.__class__.__name__)
+        self._check_port_profile(vif)
 
         v1_name, v2_name = self.get_veth_pair_names(vif)
 
-        if linux_net.device_exists(vif.bridge_name):
-            processutils.execute('brctl', 'delif', vif.bridge_name, v1_name,
-                                 run_as_root=True)
-            processutils.execute('ip', 'link', 'set', vif.bridge_name, 'down',
-                                 run_as_root=True)
-            processutils.execute('brctl', 'delbr', vif.bridge_name,
-                                 run_as_root=True)
+        if vif.bridge_name in linux_net.get_net_devices():
+            linux_net.delete_bridge(vif.bridge_name, v1_name)
 
         linux_net.delete_ovs_vif_port(vif.network.bridge, v2_name,
                                       timeout=self.config.ovs_vsctl_timeout)
@@ -0,0 +1,123 @@
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import mock
+import os.path
+
+import fixtures
+import testtools
+
+from oslo_concurrency import processutils
+
+from vif_plug_ovs import exception
+from vif_plug_ovs import linux_net
+from vif_plug_ovs import privsep
+
+
+class LinuxNetTest(testtools.TestCase):
+
+    def setUp(self):
+        super(LinuxNetTest, self).setUp()
+        privsep.vif_plug.set_client_mode(False)
+        self.addCleanup(privsep.vif_plug.set_client_mode, True)
+        self.tmpdir = self.useFixture(fixtures.TempDir()).path
+
+    def test_sysfs_write_and_read(self):
+        path = os.path.join(self.tmpdir, 'multicast_snooping')
+        linux_net._sysfs_write(path, '0')
+        self.assertEqual('0', linux_net.read_sysfs(path))
+
+    def test_sysfs_write_missing_path(self):
+        path = os.path.join(self.tmpdir, 'missing', 'disable_ipv6')
+        linux_net._sysfs_write(path, '1')
+        self.assertIsNone(linux_net.read_sysfs(path))
+
+    def test_sysfs_write_missing_path_checked(self):
+        path = os.path.join(self.tmpdir, 'missing', 'forward_delay')
+        self.assertRaises(IOError, linux_net._sysfs_write, path, '0',
+                          check=True)
+
+    def test_create_bridge_forward_delay_failure(self):
+        with mock.patch.object(processutils, 'execute'), \
+                mock.patch.object(linux_net, 'read_sysfs',
+                                  return_value=None), \
+                mock.patch('six.moves.builtins.open',
+                           side_effect=IOError('denied')):
+            self.assertRaises(IOError, linux_net.create_bridge,
+                              'qbrvif-xxx-yyy')
+
+    def _test_create_bridge(self, ipv6_exists):
+        calls = [mock.call('/sys/class/net/qbrvif-xxx-yyy'
+                           '/bridge/%s' % option, '0', check=check)
+                 for option, check in (('forward_delay', True),
+                                       ('stp_state', True),
+                                       ('multicast_snooping', False))]
+        if ipv6_exists:
+            calls.append(mock.call('/proc/sys/net/ipv6/conf'
+                                   '/qbrvif-xxx-yyy/disable_ipv6', '1'))
+        with mock.patch.object(processutils, 'execute') as execute, \
+                mock.patch.object(linux_net, '_sysfs_write') as sysfs_write, \
+                mock.patch.object(os.path, 'exists',
+                                  return_value=ipv6_exists):
+            linux_net.create_bridge('qbrvif-xxx-yyy')
+            execute.assert_called_once_with('ip', 'link', 'add', 'name',
+                                            'qbrvif-xxx-yyy', 'type',
+                                            'bridge')
+            self.assertEqual(calls, sysfs_write.call_args_list)
+
+    def test_create_bridge_ipv6(self):
+        self._test_create_bridge(ipv6_exists=True)
+
+    def test_create_bridge_no_ipv6(self):
+        self._test_create_bridge(ipv6_exists=False)
+
+    def test_create_bridge_sysfs_already_set(self):
+        with mock.patch.object(processutils, 'execute'), \
+                mock.patch.object(linux_net, 'read_sysfs',
+                                  side_effect=['0', '0', '0', '1']), \
+                mock.patch.object(linux_net, '_sysfs_write') as sysfs_write, \
+                mock.patch.object(os.path, 'exists', return_value=True):
+            linux_net.create_bridge('qbrvif-xxx-yyy')
+            self.assertFalse(sysfs_write.called)
+
+    def test_add_bridge_port(self):
+        with mock.patch.object(processutils, 'execute') as execute:
+            linux_net.add_bridge_port('qbrvif-xxx-yyy', 'qvbb679325f-ca')
+            execute.assert_called_once_with(
+                'ip', '-batch', '-',
+                process_input='link set qbrvif-xxx-yyy up\n'
+                              'link set qvbb679325f-ca master '
+                              'qbrvif-xxx-yyy\n')
+
+    def test_create_veth_pair_deletes_listed_devices(self):
+        with mock.patch.object(processutils, 'execute') as execute, \
+                mock.patch.object(linux_net, 'get_net_devices') as listing:
+            linux_net.create_veth_pair('qvb1', 'qvo1', 1500,
+                                       netdevs=set(['qvb1']))
+            self.assertFalse(listing.called)
+            self.assertEqual(mock.call('ip', 'link', 'delete', 'qvb1',
+                                       check_exit_code=[0, 2, 254]),
+                             execute.call_args_list[0])
+            self.assertEqual(4, execute.call_count)
+
+    def test_invalid_device_names_rejected(self):
+        with mock.patch.object(processutils, 'execute') as execute:
+            for name in ('br0 up\nlink delete eth0', 'br0\n', 'a' * 16,
+                         '../eth0', '', '..'):
+                self.assertRaises(exception.InvalidDeviceName,
+                                  linux_net.create_bridge, name)
+                self.assertRaises(exception.InvalidDeviceName,
+                                  linux_net.add_bridge_port, 'br0', name)
+                self.assertRaises(exception.InvalidDeviceName,
+                                  linux_net.create_veth_pair,
+                                  name, 'qvo1', 1500, netdevs=set())
+            self.assertFalse(execute.called)
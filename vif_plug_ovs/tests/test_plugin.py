@@ -12,14 +12,12 @@
 
 import contextlib
 import mock
-import os.path
 import six
 import testtools
 
 from os_vif import objects
 
-from oslo_concurrency import processutils
-
+from vif_plug_ovs import exception
 from vif_plug_ovs import linux_net
 from vif_plug_ovs import ovs_hybrid
 
@@ -74,23 +72,14 @@ class PluginTest(testtools.TestCase):
             name='demo',
             uuid='f0000000-0000-0000-0000-000000000001')
 
-    def _test_plug_ovs_hybrid(self, ipv6_exists):
+    def test_plug_ovs_hybrid(self):
         calls = {
-            'device_exists': [mock.call('qbrvif-xxx-yyy'),
-                              mock.call('qvob679325f-ca')],
-            '_create_veth_pair': [mock.call('qvbb679325f-ca',
-                                            'qvob679325f-ca',
-                                            1500)],
-            'execute': [mock.call('brctl', 'addbr', 'qbrvif-xxx-yyy',
-                                  run_as_root=True),
-                        mock.call('brctl', 'setfd', 'qbrvif-xxx-yyy', 0,
-                                  run_as_root=True),
-                        mock.call('brctl', 'stp', 'qbrvif-xxx-yyy', 'off',
-                                  run_as_root=True),
-                        mock.call('tee', ('/sys/class/net/qbrvif-xxx-yyy'
-                                          '/bridge/multicast_snooping'),
-                                  process_input='0', run_as_root=True,
-                                  check_exit_code=[0, 1])],
+            'create_bridge': [mock.call('qbrvif-xxx-yyy')],
+            'create_veth_pair': [mock.call('qvbb679325f-ca',
+                                           'qvob679325f-ca',
+                                           1500, netdevs=set())],
+            'add_bridge_port': [mock.call('qbrvif-xxx-yyy',
+                                          'qvbb679325f-ca')],
             'create_ovs_vif_port': [mock.call(
                                     'br0', 'qvob679325f-ca',
                                     'e65867e0-9340-4a7f-a256-09af6eb7a3aa',
@@ -99,77 +88,98 @@ class PluginTest(testtools.TestCase):
                                     1500,
                                     timeout=120)]
         }
-        # The disable_ipv6 call needs to be added in the middle, if required
-        if ipv6_exists:
-            calls['execute'].extend([
-                mock.call('tee', ('/proc/sys/net/ipv6/conf'
-                                  '/qbrvif-xxx-yyy/disable_ipv6'),
-                          process_input='1', run_as_root=True,
-                          check_exit_code=[0, 1])])
-        calls['execute'].extend([
-            mock.call('ip', 'link', 'set', 'qbrvif-xxx-yyy', 'up',
-                      run_as_root=True),
-            mock.call('brctl', 'addif', 'qbrvif-xxx-yyy',
-                      'qvbb679325f-ca', run_as_root=True)])
 
         with nested(
-                mock.patch.object(linux_net, 'device_exists',
-                                  return_value=False),
-                mock.patch.object(processutils, 'execute'),
+                mock.patch.object(linux_net, 'get_net_devices',
+                                  return_value=set()),
+                mock.patch.object(linux_net, 'create_bridge'),
                 mock.patch.object(linux_net, 'create_veth_pair'),
-                mock.patch.object(linux_net, 'create_ovs_vif_port'),
-                mock.patch.object(os.path, 'exists', return_value=ipv6_exists)
-        ) as (device_exists, execute, _create_veth_pair, create_ovs_vif_port,
-              path_exists):
+                mock.patch.object(linux_net, 'add_bridge_port'),
+                mock.patch.object(linux_net, 'create_ovs_vif_port')
+        ) as (get_net_devices, create_bridge, create_veth_pair,
+              add_bridge_port, create_ovs_vif_port):
             plugin = ovs_hybrid.OvsHybridPlugin.load("ovs_hybrid")
             plugin.plug(self.vif_ovs, self.instance)
-            device_exists.assert_has_calls(calls['device_exists'])
-            _create_veth_pair.assert_has_calls(calls['_create_veth_pair'])
-            execute.assert_has_calls(calls['execute'])
+            get_net_devices.assert_called_once_with()
+            create_bridge.assert_has_calls(calls['create_bridge'])
+            create_veth_pair.assert_has_calls(calls['create_veth_pair'])
+            add_bridge_port.assert_has_calls(calls['add_bridge_port'])
             create_ovs_vif_port.assert_has_calls(calls['create_ovs_vif_port'])
 
-    def test_plug_ovs_hybrid_ipv6(self):
-        self._test_plug_ovs_hybrid(ipv6_exists=True)
-
-    def test_plug_ovs_hybrid_no_ipv6(self):
-        self._test_plug_ovs_hybrid(ipv6_exists=False)
-
     def test_unplug_ovs_hybrid(self):
         calls = {
-            'device_exists': [mock.call('qbrvif-xxx-yyy')],
-            'execute': [mock.call('brctl', 'delif', 'qbrvif-xxx-yyy',
-                                  'qvbb679325f-ca', run_as_root=True),
-                        mock.call('ip', 'link', 'set',
-                                  'qbrvif-xxx-yyy', 'down', run_as_root=True),
-                        mock.call('brctl', 'delbr',
-                                  'qbrvif-xxx-yyy', run_as_root=True)],
+            'delete_bridge': [mock.call('qbrvif-xxx-yyy', 'qvbb679325f-ca')],
             'delete_ovs_vif_port': [mock.call('br0', 'qvob679325f-ca',
                                     timeout=120)]
         }
         with nested(
-                mock.patch.object(linux_net, 'device_exists',
-                                  return_value=True),
-                mock.patch.object(processutils, 'execute'),
+                mock.patch.object(linux_net, 'get_net_devices',
+                                  return_value=set(['qbrvif-xxx-yyy'])),
+                mock.patch.object(linux_net, 'delete_bridge'),
                 mock.patch.object(linux_net, 'delete_ovs_vif_port')
-        ) as (device_exists, execute, delete_ovs_vif_port):
+        ) as (get_net_devices, delete_bridge, delete_ovs_vif_port):
             plugin = ovs_hybrid.OvsHybridPlugin.load("ovs_hybrid")
             plugin.unplug(self.vif_ovs, self.instance)
-            device_exists.assert_has_calls(calls['device_exists'])
-            execute.assert_has_calls(calls['execute'])
+            get_net_devices.assert_called_once_with()
+            delete_bridge.assert_has_calls(calls['delete_bridge'])
             delete_ovs_vif_port.assert_has_calls(calls['delete_ovs_vif_port'])
 
+    def test_plug_ovs_hybrid_devices_exist(self):
+        with nested(
+                mock.patch.object(linux_net, 'get_net_devices',
+                                  return_value=set(['qbrvif-xxx-yyy',
+                                                    'qvob679325f-ca'])),
+                mock.patch.object(linux_net, 'create_bridge'),
+                mock.patch.object(linux_net, 'create_veth_pair')
+        ) as (get_net_devices, create_bridge, create_veth_pair):
+            plugin = ovs_hybrid.OvsHybridPlugin.load("ovs_hybrid")
+            plugin.plug(self.vif_ovs, self.instance)
+            self.assertFalse(create_bridge.called)
+            self.assertFalse(create_veth_pair.called)
+
     def test_unplug_ovs_hybrid_bridge_does_not_exist(self):
         calls = {
-            'device_exists': [mock.call('qbrvif-xxx-yyy')],
             'delete_ovs_vif_port': [mock.call('br0', 'qvob679325f-ca',
                                               timeout=120)]
         }
         with nested(
-                mock.patch.object(linux_net, 'device_exists',
-                                  return_value=False),
+                mock.patch.object(linux_net, 'get_net_devices',
+                                  return_value=set()),
                 mock.patch.object(linux_net, 'delete_ovs_vif_port')
-        ) as (device_exists, delete_ovs_vif_port):
+        ) as (get_net_devices, delete_ovs_vif_port):
             plugin = ovs_hybrid.OvsHybridPlugin.load("ovs_hybrid")
             plugin.unplug(self.vif_ovs, self.instance)
-            device_exists.assert_has_calls(calls['device_exists'])
+            get_net_devices.assert_called_once_with()
             delete_ovs_vif_port.assert_has_calls(calls['delete_ovs_vif_port'])
+
+    def test_get_veth_pair_names(self):
+        self.assertEqual(('qvbb679325f-ca', 'qvob679325f-ca'),
+                         ovs_hybrid.OvsHybridPlugin.get_veth_pair_names(
+                             self.vif_ovs))
+        self.assertIs(ovs_hybrid.OvsHybridPlugin.get_veth_pair_names(
+                          self.vif_ovs),
+                      ovs_hybrid.OvsHybridPlugin.get_veth_pair_names(
+                          self.vif_ovs))
+
+    def test_plug_ovs_hybrid_missing_port_profile(self):
+        vif = objects.vif.VIFBridge(
+            id='b679325f-ca89-4ee0-a8be-6db1409b69ea',
+            network=self.network_ovs,
+            bridge_name="qbrvif-xxx-yyy")
+        plugin = ovs_hybrid.OvsHybridPlugin.load("ovs_hybrid")
+        self.assertRaises(exception.MissingPortProfile,
+                          plugin.plug, vif, self.instance)
+        self.assertRaises(exception.MissingPortProfile,
+                          plugin.unplug, vif, self.instance)
+
+    def test_plug_ovs_hybrid_wrong_port_profile(self):
+        vif = objects.vif.VIFBridge(
+            id='b679325f-ca89-4ee0-a8be-6db1409b69ea',
+            network=self.network_ovs,
+            bridge_name="qbrvif-xxx-yyy",
+            port_profile=objects.vif.VIFPortProfile8021Qbg(
+                manager_id=1, type_id=2, type_id_version=3,
+                instance_id='f0000000-0000-0000-0000-000000000001'))
+        plugin = ovs_hybrid.OvsHybridPlugin.load("ovs_hybrid")
+        self.assertRaises(exception.WrongPortProfile,
+                          plugin.plug, vif, self.instance)